@@ -2,13 +2,20 @@ import os
 import asyncio
 import logging
 import re
+import sqlite3
+import threading
+import time
 import aiosqlite
-import pytz
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
+from cachetools import LRUCache, TTLCache
 
-from aiogram import Bot, Dispatcher, types, BaseMiddleware, Router
+from aiogram import Bot, Dispatcher, types, BaseMiddleware, Router, F
 from aiogram.enums import ParseMode
 from aiogram.filters import CommandStart, Command
+from aiogram.filters.callback_data import CallbackData
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.storage.memory import MemoryStorage
@@ -20,8 +27,10 @@ from aiogram.client.bot import DefaultBotProperties
 from dotenv import load_dotenv
 
 # Для работы с Google Calendar
+import google_auth_httplib2
 from google.oauth2 import service_account
 from googleapiclient.discovery import build
+from googleapiclient.http import build_http
 
 # LangChain/GigaChat
 from langchain_core.messages import HumanMessage, SystemMessage
@@ -37,6 +46,17 @@ logger = logging.getLogger(__name__)
 # Конфигурация
 # ==================================================
 DATABASE = 'users.db'
+DB_READERS = 4  # Количество read-only соединений в пуле
+MIN_SQLITE_VERSION = (3, 35, 0)  # INSERT/UPDATE/DELETE ... RETURNING
+DB_CACHED_STATEMENTS = 256  # Размер кэша подготовленных запросов sqlite3 на соединение (по умолчанию 128)
+# Настройки SQLite, применяемые к каждому соединению пула
+SQLITE_PRAGMAS = (
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=30000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-64000",
+    "PRAGMA foreign_keys=ON",
+)
 
 TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
 GIGACHAT_API_KEY = os.getenv('GIGACHAT_API_KEY')
@@ -45,6 +65,35 @@ GIGACHAT_API_KEY = os.getenv('GIGACHAT_API_KEY')
 SERVICE_ACCOUNT_FILE = os.getenv('SERVICE_ACCOUNT_FILE', 'test-fortgbot-2312e65c9aec.json')
 CALENDAR_ID = os.getenv('CALENDAR_ID')  # ID календаря
 TIMEZONE = 'Europe/Moscow'  # Часовой пояс
+TZ = ZoneInfo(TIMEZONE)
+# Формат, в котором дата/время записи хранится в БД: 'дд.мм.гг чч:мм:сс'.
+# Если у вас 4-значный год, поменяйте на '%d.%m.%Y %H:%M:%S'
+SLOT_FORMAT = "%d.%m.%y %H:%M:%S"
+# Форматы даты/времени, которые может вернуть GigaChat
+INPUT_DATETIME_FORMATS = ("%d.%m.%Y %H:%M", "%d.%m.%y %H:%M")
+AVAILABILITY_CACHE_TTL = 60  # Сколько секунд доверяем закэшированной проверке слота
+REMINDER_WINDOW = 7200  # За сколько секунд до начала записи отправляем напоминание
+REMINDER_POLL_INTERVAL = 60  # Пауза перед повтором неотправленных напоминаний (и первая пауза после ошибки), сек
+REMINDER_MAX_BACKOFF = 600  # Предельная пауза планировщика после подряд идущих ошибок, сек
+REMINDER_SEND_CONCURRENCY = 20  # Сколько напоминаний одновременно отправляем в Telegram (лимит ~30 сообщений/с)
+
+# Регулярные выражения, компилируем один раз
+PHONE_RE = re.compile(r'^\+\d{9,15}$')
+DATE_RE = re.compile(r"DATE:\s*(.+?)(?:\s|$)", re.IGNORECASE)
+TIME_RE = re.compile(r"TIME:\s*(.+?)(?:\s|$)", re.IGNORECASE)
+# Простой ввод вида «25.01.2025 в 14:30» разбираем без GigaChat
+QUICK_DATETIME_RE = re.compile(
+    r"(\d{1,2})\.(\d{1,2})(?:\.(\d{4}|\d{2}))?\s+(?:в\s+)?(\d{1,2})[:.](\d{2})", re.IGNORECASE
+)
+DEFAULT_YEAR = 2025  # Год по умолчанию, если пользователь его не указал
+
+# Русские названия услуг по коду из callback_data
+SERVICE_NAMES = {
+    "manicure": "Маникюр",
+    "pedicure": "Педикюр",
+    "eyebrows": "Брови",
+    "eyelashes": "Ресницы",
+}
 
 # Проверка необходимых ключей
 if not TELEGRAM_BOT_TOKEN or not GIGACHAT_API_KEY:
@@ -59,16 +108,28 @@ class GC:
     SCOPES = ['https://www.googleapis.com/auth/calendar']
 
     def __init__(self):
-        credentials = service_account.Credentials.from_service_account_file(
+        self.credentials = service_account.Credentials.from_service_account_file(
             filename=SERVICE_ACCOUNT_FILE, scopes=self.SCOPES
         )
-        self.service = build('calendar', 'v3', credentials=credentials)
+        # Клиент строится один раз при старте; кэш discovery-документа на диске не нужен
+        self.service = build('calendar', 'v3', credentials=self.credentials, cache_discovery=False)
+        # httplib2.Http не потокобезопасен, поэтому у каждого потока из GCAL_POOL
+        # своё авторизованное соединение, которое переживает между вызовами (keep-alive)
+        self._local = threading.local()
+
+    def _http(self):
+        http = getattr(self._local, 'http', None)
+        if http is None:
+            # build_http(), как и сам build(): таймаут 60 с, чтобы зависшее соединение не занимало поток навсегда
+            http = google_auth_httplib2.AuthorizedHttp(self.credentials, http=build_http())
+            self._local.http = http
+        return http
 
     def add_event(self, calendar_id, body):
         return self.service.events().insert(
             calendarId=calendar_id,
             body=body
-        ).execute()
+        ).execute(http=self._http())
 
     def delete_event(self, calendar_id, event_id):
         """
@@ -77,27 +138,92 @@ class GC:
         return self.service.events().delete(
             calendarId=calendar_id,
             eventId=event_id
-        ).execute()
+        ).execute(http=self._http())
 
-    def check_availability(self, calendar_id, start_time, end_time):
-        events_result = self.service.events().list(
-            calendarId=calendar_id,
-            timeMin=start_time.isoformat(),
-            timeMax=end_time.isoformat(),
-            singleEvents=True,
-            orderBy='startTime'
-        ).execute()
-        events = events_result.get('items', [])
-        return len(events) == 0
+    def get_busy(self, calendar_id, start_time, end_time):
+        """
+        Возвращает занятые интервалы календаря ([{'start': ..., 'end': ...}]) через FreeBusy API.
+        """
+        response = self.service.freebusy().query(
+            body={
+                'timeMin': start_time.isoformat(),
+                'timeMax': end_time.isoformat(),
+                'timeZone': TIMEZONE,
+                'items': [{'id': calendar_id}],
+            },
+            # Partial response: нужны только интервалы занятости и ошибки
+            fields='calendars',
+        ).execute(http=self._http())
+        calendar = response['calendars'][calendar_id]
+        # При ошибке доступа FreeBusy возвращает пустой busy, поэтому не считаем слот свободным
+        if calendar.get('errors'):
+            raise RuntimeError(f"FreeBusy error: {calendar['errors']}")
+        return calendar['busy']
 
 
 # Создаём глобальный объект для работы с календарём
 calendar_service = GC()
+# Отдельный пул потоков для запросов к Google Calendar, чтобы они не делили
+# стандартный executor цикла с прочими блокирующими вызовами
+GCAL_POOL = ThreadPoolExecutor(max_workers=8, thread_name_prefix="gcal")
 
 
 # ==================================================
 # Функции для работы с Google Calendar (асинхронные)
 # ==================================================
+def parse_slot(date_str: str, time_str: str) -> datetime:
+    """
+    Превращает дату (дд.мм.гг) и время (чч:мм:сс) записи в datetime с часовым поясом TZ.
+    """
+    return datetime.strptime(f"{date_str} {time_str}", SLOT_FORMAT).replace(tzinfo=TZ)
+
+
+def slot_epoch(date_time_str: str) -> int:
+    """
+    Переводит дату/время записи ('дд.мм.гг чч:мм:сс') в секунды Unix (столбец dt_epoch).
+    """
+    return int(datetime.strptime(date_time_str, SLOT_FORMAT).replace(tzinfo=TZ).timestamp())
+
+
+# Кэш занятости календаря по дням: дата (дд.мм.гг) -> занятые интервалы.
+# Записи живут AVAILABILITY_CACHE_TTL секунд, размер ограничен, чтобы не копить все введённые даты
+BUSY_CACHE = TTLCache(maxsize=256, ttl=AVAILABILITY_CACHE_TTL)
+
+
+def invalidate_availability(date_str: str):
+    """
+    Сбрасывает закэшированную занятость на указанную дату (дд.мм.гг).
+    """
+    BUSY_CACHE.pop(date_str, None)
+
+
+async def get_busy_intervals(date_str: str):
+    """
+    Возвращает занятые интервалы [(start, end), ...] на дату (дд.мм.гг).
+    Весь день запрашивается одним вызовом FreeBusy и кэшируется на AVAILABILITY_CACHE_TTL секунд,
+    так что перебор пользователем нескольких вариантов времени не ходит в Google каждый раз.
+    """
+    cached = BUSY_CACHE.get(date_str)
+    if cached is not None:
+        return cached
+
+    day_start = parse_slot(date_str, "00:00:00")
+    # Берём с запасом в час: запись в 23:30 заканчивается уже на следующий день
+    day_end = day_start + timedelta(days=1, hours=1)
+
+    loop = asyncio.get_running_loop()
+    busy = await loop.run_in_executor(
+        GCAL_POOL, calendar_service.get_busy, CALENDAR_ID, day_start, day_end
+    )
+    intervals = [
+        (datetime.fromisoformat(b['start'].replace('Z', '+00:00')),
+         datetime.fromisoformat(b['end'].replace('Z', '+00:00')))
+        for b in busy
+    ]
+    BUSY_CACHE[date_str] = intervals
+    return intervals
+
+
 async def save_to_calendar(appointment_id: int, user_id: int, service_name: str, date_str: str, time_str: str,
                            user_phone: str):
     """
@@ -109,24 +235,25 @@ async def save_to_calendar(appointment_id: int, user_id: int, service_name: str,
     чтобы при отмене записи удалить и из календаря.
     """
     try:
-        tz = pytz.timezone(TIMEZONE)
-        # Если у вас 4-значный год, поменяйте на '%d.%m.%Y %H:%M:%S'
-        dt = datetime.strptime(f"{date_str} {time_str}", "%d.%m.%y %H:%M:%S")
-        start_time = tz.localize(dt)
+        start_time = parse_slot(date_str, time_str)
         end_time = start_time + timedelta(hours=1)
 
-        # Получаем имя/фамилию из БД
-        async with aiosqlite.connect(DATABASE) as db:
-            cursor = await db.execute("SELECT first_name, last_name FROM users WHERE id = ?", (user_id,))
+        # Получаем имя/фамилию и username из БД
+        async with pool.reader() as db:
+            cursor = await db.execute("SELECT first_name, last_name, username FROM users WHERE id = ?", (user_id,))
             row = await cursor.fetchone()
-            if row:
-                first_name, last_name = row
-            else:
-                first_name, last_name = 'Неизвестно', ''
-
-        # Получаем username
-        user = await bot.get_chat(user_id)
-        username = user.username if user.username else f"tg://user?id={user_id}"
+        if row:
+            first_name, last_name, username = row
+        else:
+            first_name, last_name, username = 'Неизвестно', '', None
+
+        # username сохраняется при регистрации; у старых пользователей его нет (NULL) — спрашиваем Telegram
+        # один раз и запоминаем в БД вместе с google_event_id ниже. '' означает «username у пользователя нет»
+        fetched_username = None
+        if username is None:
+            user = await bot.get_chat(user_id)
+            username = fetched_username = user.username or ''
+        username = username if username else f"tg://user?id={user_id}"
         telegram_link = f"https://t.me/{username}"
 
         event = {
@@ -148,23 +275,26 @@ async def save_to_calendar(appointment_id: int, user_id: int, service_name: str,
 
         loop = asyncio.get_running_loop()
         event_result = await loop.run_in_executor(
-            None, lambda: calendar_service.add_event(CALENDAR_ID, event)
+            GCAL_POOL, calendar_service.add_event, CALENDAR_ID, event
         )
-        logger.info(f"Event created: {event_result.get('htmlLink')}")
+        logger.info("Event created: %s", event_result.get('htmlLink'))
 
         # Сохраняем google_event_id в БД
         google_event_id = event_result.get('id')
-        async with aiosqlite.connect(DATABASE) as db:
+        async with pool.writer() as db:
             await db.execute('''
                 UPDATE appointments
                 SET google_event_id = ?
                 WHERE id = ?
             ''', (google_event_id, appointment_id))
+            if fetched_username is not None:
+                await db.execute("UPDATE users SET username = ? WHERE id = ?", (fetched_username, user_id))
             await db.commit()
+        invalidate_availability(date_str)
 
         return start_time, end_time
     except Exception as e:
-        logger.error(f"Error creating calendar event for user {user_id}: {e}")
+        logger.error("Error creating calendar event for user %s: %s", user_id, e)
         await bot.send_message(
             chat_id=user_id,
             text="Произошла ошибка при добавлении записи в календарь. Пожалуйста, попробуйте позже."
@@ -172,25 +302,41 @@ async def save_to_calendar(appointment_id: int, user_id: int, service_name: str,
         return None, None
 
 
+# Держим ссылки на фоновые задачи, иначе незавершённую задачу может забрать сборщик мусора
+BACKGROUND_TASKS = set()
+
+
+def _background_done(task: asyncio.Task):
+    BACKGROUND_TASKS.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("Ошибка в фоновой задаче: %r", task.exception())
+
+
+def run_in_background(coro) -> asyncio.Task:
+    """
+    Запускает корутину фоновой задачей; необработанное исключение попадёт в лог, а не потеряется.
+    """
+    task = asyncio.create_task(coro)
+    BACKGROUND_TASKS.add(task)
+    task.add_done_callback(_background_done)
+    return task
+
+
 async def check_availability(date: str, time_: str) -> bool:
     """
     Проверяем, доступен ли слот (дд.мм.гг чч:мм:сс) в Google Calendar.
+    Пересечение считаем локально по занятости за весь день (см. get_busy_intervals).
     """
     try:
-        tz = pytz.timezone(TIMEZONE)
-        dt = datetime.strptime(f"{date} {time_}", "%d.%m.%y %H:%M:%S")
-        start_time = tz.localize(dt)
+        start_time = parse_slot(date, time_)
         end_time = start_time + timedelta(hours=1)
 
-        logger.info(f"Checking availability: start={start_time.isoformat()}, end={end_time.isoformat()}")
+        logger.info("Checking availability: start=%s, end=%s", start_time, end_time)
 
-        loop = asyncio.get_running_loop()
-        is_available = await loop.run_in_executor(
-            None, lambda: calendar_service.check_availability(CALENDAR_ID, start_time, end_time)
-        )
-        return is_available
+        busy = await get_busy_intervals(date)
+        return not any(busy_start < end_time and start_time < busy_end for busy_start, busy_end in busy)
     except Exception as e:
-        logger.error(f"Error in check_availability: {e}")
+        logger.error("Error in check_availability: %s", e)
         return False
 
 
@@ -215,6 +361,61 @@ llm = GigaChat(
     streaming=False,
 )
 
+# Кэш разбора даты/времени: (сегодняшняя дата, текст пользователя) -> (дата, время).
+# Сегодняшняя дата в ключе, т.к. «завтра в 14:00» каждый день означает разное.
+DATETIME_CACHE = LRUCache(maxsize=512)
+
+
+async def extract_date_time(user_input: str):
+    """
+    Выделяет из текста пользователя дату и время.
+    Возвращает (дата, время) — любое из них может быть None, если GigaChat его не нашёл, —
+    или None, если GigaChat ответил NOT_FOUND.
+    """
+    quick_match = QUICK_DATETIME_RE.search(user_input)
+    if quick_match:
+        day, month, year, hour, minute = quick_match.groups()
+        quick_date, quick_time = f"{day}.{month}.{year or DEFAULT_YEAR}", f"{hour}:{minute}"
+        # Ввод вида «14.30 25.01» тоже совпадёт с шаблоном, но даст несуществующие дату/время —
+        # такой текст отдаём GigaChat
+        if parse_and_format_datetime(quick_date, quick_time):
+            return quick_date, quick_time
+
+    cache_key = (datetime.now(TZ).date(), user_input.lower())
+    if cache_key in DATETIME_CACHE:
+        return DATETIME_CACHE[cache_key]
+
+    # Отправляем запрос GigaChat
+    system_prompt = SystemMessage(
+        content="Ты – ассистент, извлекающий дату и время из текста."
+    )
+    user_prompt = HumanMessage(
+        content=(
+                "Текст пользователя: «" + user_input + "»\n\n"
+                                                       "Требуется выделить предполагаемую дату и время. "
+                                                       f"Если в дате не указан год, то ставь по умолчанию {DEFAULT_YEAR}."
+                                                        "Формат ответа: DATE: <дд.чч.гггг> TIME: <время>, "
+                                                       "или NOT_FOUND, если не удалось определить."
+        )
+    )
+    # Асинхронный вызов, чтобы запрос к GigaChat не блокировал event loop
+    response = await llm.ainvoke([system_prompt, user_prompt])
+    content = response.content.strip()
+    logger.info("GigaChat response: %s", content)
+
+    if "NOT_FOUND" in content.upper():
+        return None
+
+    date_match = DATE_RE.search(content)
+    time_match = TIME_RE.search(content)
+
+    extracted_date = date_match.group(1).strip() if date_match else None
+    extracted_time = time_match.group(1).strip() if time_match else None
+
+    if extracted_date and extracted_time:
+        DATETIME_CACHE[cache_key] = (extracted_date, extracted_time)
+    return extracted_date, extracted_time
+
 
 # ==================================================
 # Состояния для регистрации
@@ -236,26 +437,168 @@ class RegistrationMiddleware(BaseMiddleware):
             if state:
                 current_state = await state.get_state()
                 if current_state is None:
-                    # Проверяем, есть ли user_id в БД
-                    async with aiosqlite.connect(DATABASE) as db:
-                        async with db.execute(
-                                "SELECT id FROM users WHERE id = ?",
-                                (user_id,)
-                        ) as cursor:
-                            if await cursor.fetchone() is None:
-                                await bot.send_message(
-                                    user_id,
-                                    "Вы не зарегистрированы! Введите /start для начала регистрации."
-                                )
-                                return
+                    # Проверяем, есть ли user_id среди зарегистрированных (без похода в БД)
+                    if user_id not in REGISTERED:
+                        await bot.send_message(
+                            user_id,
+                            "Вы не зарегистрированы! Введите /start для начала регистрации."
+                        )
+                        return
         return await handler(event, data)
 
 
+# ==================================================
+# Пул соединений с БД
+# ==================================================
+class AsyncConnectionPool:
+    """
+    Долгоживущие соединения с SQLite: один писатель и несколько читателей.
+    В режиме WAL читатели не блокируются писателем, а записи сериализуются
+    через lock, т.к. SQLite всё равно допускает только одного писателя.
+    """
+
+    def __init__(self, database, readers):
+        self.database = database
+        self.readers_count = readers
+        self._writer = None
+        self._write_lock = None
+        self._readers = None
+
+    async def open(self):
+        # Писатель открывается первым: он создаёт файл БД и переводит его в WAL
+        # (режим сохраняется в самом файле, для БД в памяти WAL не поддерживается).
+        # isolation_level=None: sqlite3 не открывает транзакции сам, их границы задаёт writer()
+        self._writer = await aiosqlite.connect(
+            self.database, isolation_level=None, cached_statements=DB_CACHED_STATEMENTS
+        )
+        if self.database != ':memory:':
+            await self._writer.execute("PRAGMA journal_mode=WAL")
+        await self._setup(self._writer)
+        self._write_lock = asyncio.Lock()
+
+        self._readers = asyncio.Queue()
+        for _ in range(self.readers_count):
+            conn = await aiosqlite.connect(
+                f"file:{self.database}?mode=ro", uri=True, cached_statements=DB_CACHED_STATEMENTS
+            )
+            await self._setup(conn)
+            self._readers.put_nowait(conn)
+
+    @staticmethod
+    async def _setup(conn):
+        for pragma in SQLITE_PRAGMAS:
+            await conn.execute(pragma)
+
+    @asynccontextmanager
+    async def reader(self):
+        conn = await self._readers.get()
+        try:
+            yield conn
+        finally:
+            self._readers.put_nowait(conn)
+
+    @asynccontextmanager
+    async def writer(self):
+        """
+        Транзакция записи: BEGIN IMMEDIATE сразу берёт блокировку SQLite на запись,
+        без повышения deferred-транзакции на первом UPDATE. Если внутри блока не было
+        явного db.commit(), транзакция фиксируется при выходе.
+        """
+        async with self._write_lock:
+            await self._writer.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._writer
+                if self._writer.in_transaction:
+                    await self._writer.commit()
+            except BaseException:
+                # Не оставляем незавершённую транзакцию следующему писателю
+                await self._writer.rollback()
+                raise
+
+    async def close(self):
+        if self._readers is not None:
+            while not self._readers.empty():
+                await self._readers.get_nowait().close()
+        if self._writer is not None:
+            await self._writer.close()
+
+
+pool = AsyncConnectionPool(DATABASE, readers=DB_READERS)
+
+
 # ==================================================
 # Инициализация БД
 # ==================================================
+# id зарегистрированных пользователей (загружается в start_db, пополняется в reg_phone).
+# Единственный источник проверки регистрации для /start и RegistrationMiddleware.
+REGISTERED = set()
+
+# Версия схемы БД, хранится в PRAGMA user_version
+SCHEMA_VERSION = 3
+
+
+async def add_column_if_missing(db, table: str, column: str, ddl: str):
+    async with db.execute(f"PRAGMA table_info({table})") as cursor:
+        columns = {row[1] for row in await cursor.fetchall()}
+    if column not in columns:
+        await db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}")
+
+
+async def migrate_db(db):
+    """
+    Доводит схему существующей БД до SCHEMA_VERSION.
+    Если версия уже актуальна, ничего не делает.
+    """
+    async with db.execute("PRAGMA user_version") as cursor:
+        (version,) = await cursor.fetchone()
+    if version >= SCHEMA_VERSION:
+        return
+
+    if version < 1:
+        # Столбцы, которых может не быть в таблицах, созданных старыми версиями бота
+        await add_column_if_missing(db, "appointments", "google_event_id", "TEXT")
+        await add_column_if_missing(db, "appointments", "reminded", "BOOLEAN DEFAULT 0")
+        await add_column_if_missing(db, "users", "username", "TEXT")
+
+    if version < 2:
+        # «Мои Записи»: WHERE user_id = ? ORDER BY id DESC — поиск по индексу вместо полного прохода
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_appointments_user_id ON appointments(user_id)")
+
+    if version < 3:
+        # Время записи в секундах Unix: планировщик напоминаний фильтрует по нему в SQL
+        await add_column_if_missing(db, "appointments", "dt_epoch", "INTEGER")
+        rows = await db.execute_fetchall(
+            "SELECT id, date_time FROM appointments WHERE date_time IS NOT NULL AND dt_epoch IS NULL"
+        )
+        updates = []
+        for app_id, date_time in rows:
+            try:
+                updates.append((slot_epoch(date_time), app_id))
+            except ValueError:
+                pass  # некорректный формат, такой записи напоминание не придёт
+        await db.executemany("UPDATE appointments SET dt_epoch = ? WHERE id = ?", updates)
+        await db.execute(
+            "CREATE INDEX IF NOT EXISTS idx_appt_due ON appointments(status, reminded, dt_epoch)"
+        )
+        # ANALYZE здесь не запускаем: статистика, снятая на почти пустой таблице, потом не обновляется,
+        # и планировщик начинает сканировать таблицу вместо поиска по idx_appt_due
+
+    await db.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+    logger.info("Схема БД обновлена с версии %s до %s", version, SCHEMA_VERSION)
+
+
 async def start_db():
-    async with aiosqlite.connect(DATABASE) as db:
+    # Без RETURNING бот запустится, но каждое нажатие кнопки записи будет падать с ошибкой SQL
+    if sqlite3.sqlite_version_info < MIN_SQLITE_VERSION:
+        logger.error(
+            "Нужна SQLite %s или новее, установлена %s.",
+            ".".join(map(str, MIN_SQLITE_VERSION)), sqlite3.sqlite_version
+        )
+        exit(1)
+
+    await pool.open()
+
+    async with pool.writer() as db:
         # Таблица пользователей
         await db.execute('''
             CREATE TABLE IF NOT EXISTS users (
@@ -264,7 +607,8 @@ async def start_db():
                 last_name TEXT,
                 phone TEXT,
                 statusrem BOOLEAN,
-                pending_appointment_id INTEGER
+                pending_appointment_id INTEGER,
+                username TEXT
             )
         ''')
         # Таблица записей
@@ -277,23 +621,52 @@ async def start_db():
                 status TEXT DEFAULT 'pending',
                 created_at TEXT,
                 google_event_id TEXT,
-                reminded BOOLEAN DEFAULT 0
+                reminded BOOLEAN DEFAULT 0,
+                dt_epoch INTEGER  -- date_time в секундах Unix, для выборки напоминаний
             )
         ''')
 
-        # Если таблица уже создана, возможно столбцов нет – добавим через ALTER
-        # Это защитит от ошибок при обновлении кода.
-        try:
-            await db.execute("ALTER TABLE appointments ADD COLUMN google_event_id TEXT")
-        except:
-            pass
-        try:
-            await db.execute("ALTER TABLE appointments ADD COLUMN reminded BOOLEAN DEFAULT 0")
-        except:
-            pass
+        # Если таблица уже создана старой версией, доводим её схему до актуальной
+        await migrate_db(db)
 
         await db.commit()
 
+    async with pool.reader() as db:
+        cursor = await db.execute("SELECT id FROM users")
+        REGISTERED.update(user_id for (user_id,) in await cursor.fetchall())
+
+
+# ==================================================
+# SQL-запросы горячих путей
+# ==================================================
+# Один и тот же текст запроса на долгоживущем соединении берётся из кэша
+# подготовленных выражений sqlite3, а не разбирается заново
+SQL_CONFIRM_APPOINTMENT = '''
+    UPDATE appointments
+    SET status='confirmed'
+    WHERE id = ? AND user_id = ? AND status = 'pending' AND date_time IS NOT NULL
+    RETURNING date_time, service, (SELECT phone FROM users WHERE id = ?)
+'''
+SQL_RESET_PENDING = "UPDATE users SET pending_appointment_id = NULL WHERE id = ?"
+SQL_DELETE_APPOINTMENT = '''
+    DELETE FROM appointments
+    WHERE id = ? AND user_id = ?
+    RETURNING date_time, google_event_id
+'''
+SQL_RESET_PENDING_IF = "UPDATE users SET pending_appointment_id = NULL WHERE id = ? AND pending_appointment_id = ?"
+SQL_DUE_REMINDERS = '''
+    SELECT id, user_id, service, date_time
+    FROM appointments
+    WHERE status = 'confirmed' AND reminded = 0
+      AND dt_epoch > ? AND dt_epoch <= ?
+'''
+SQL_MARK_REMINDED = "UPDATE appointments SET reminded=1 WHERE id=?"
+SQL_NEXT_REMINDER = '''
+    SELECT MIN(dt_epoch)
+    FROM appointments
+    WHERE status = 'confirmed' AND reminded = 0 AND dt_epoch > ?
+'''
+
 
 # ==================================================
 # Команда /start (регистрация или меню)
@@ -301,18 +674,17 @@ async def start_db():
 @dp.message(CommandStart())
 async def cmd_start(message: Message, state: FSMContext):
     user_id = message.from_user.id
-    async with aiosqlite.connect(DATABASE) as db:
-        async with db.execute("SELECT id FROM users WHERE id = ?", (user_id,)) as cursor:
-            if await cursor.fetchone() is None:
-                # Начинаем регистрацию
-                await state.set_state(Registration.first_name)
-                await message.answer("Привет! Начнём регистрацию. Как вас зовут (имя)?")
-            else:
-                # Уже зарегистрирован
-                await message.answer(
-                    "Добро пожаловать! Выберите действие:",
-                    reply_markup=main_menu_keyboard()
-                )
+    # REGISTERED загружен из БД при старте и пополняется при регистрации, поэтому в БД не ходим
+    if user_id not in REGISTERED:
+        # Начинаем регистрацию
+        await state.set_state(Registration.first_name)
+        await message.answer("Привет! Начнём регистрацию. Как вас зовут (имя)?")
+    else:
+        # Уже зарегистрирован
+        await message.answer(
+            "Добро пожаловать! Выберите действие:",
+            reply_markup=MAIN_MENU_KB
+        )
 
 
 @dp.message(Registration.first_name)
@@ -340,7 +712,7 @@ async def reg_last_name(message: Message, state: FSMContext):
 @dp.message(Registration.phone)
 async def reg_phone(message: Message, state: FSMContext):
     phone = message.text.strip()
-    if not re.match(r'^\+\d{9,15}$', phone):
+    if not PHONE_RE.match(phone):
         await message.answer("Неверный формат номера. Укажите в формате +123456789.")
         return
 
@@ -348,84 +720,143 @@ async def reg_phone(message: Message, state: FSMContext):
     first_name = data.get('first_name')
     last_name = data.get('last_name')
 
-    async with aiosqlite.connect(DATABASE) as db:
+    async with pool.writer() as db:
         await db.execute('''
-            INSERT INTO users (id, first_name, last_name, phone, statusrem, pending_appointment_id)
-            VALUES (?, ?, ?, ?, ?, ?)
-        ''', (message.from_user.id, first_name, last_name, phone, False, None))
+            INSERT INTO users (id, first_name, last_name, phone, statusrem, pending_appointment_id, username)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', (message.from_user.id, first_name, last_name, phone, False, None, message.from_user.username or ''))
         await db.commit()
+    REGISTERED.add(message.from_user.id)
 
     await state.clear()
     await message.answer("Регистрация успешно завершена!", reply_markup=ReplyKeyboardRemove())
-    await message.answer("Выберите действие:", reply_markup=main_menu_keyboard())
+    await message.answer("Выберите действие:", reply_markup=MAIN_MENU_KB)
 
 
 # ==================================================
 # Главное меню
 # ==================================================
-def main_menu_keyboard() -> ReplyKeyboardMarkup:
-    btn1 = KeyboardButton(text="Записаться")
-    btn2 = KeyboardButton(text="Мои Записи")
-    btn3 = KeyboardButton(text="Помощь")
-    return ReplyKeyboardMarkup(
-        keyboard=[[btn1, btn2], [btn3]],
-        resize_keyboard=True
-    )
+# Клавиатуры не меняются за время работы бота, поэтому собираем их один раз
+MAIN_MENU_KB = ReplyKeyboardMarkup(
+    keyboard=[
+        [KeyboardButton(text="Записаться"), KeyboardButton(text="Мои Записи")],
+        [KeyboardButton(text="Помощь")],
+    ],
+    resize_keyboard=True
+)
 
+# Русские названия услуг
+SERVICES_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="Маникюр", callback_data="service_manicure"),
+     InlineKeyboardButton(text="Педикюр", callback_data="service_pedicure")],
+    [InlineKeyboardButton(text="Брови", callback_data="service_eyebrows"),
+     InlineKeyboardButton(text="Ресницы", callback_data="service_eyelashes")],
+])
+
+
+MESSAGE_LIMIT = 4096  # Максимальная длина сообщения Telegram
+STATUS_CANCELED = "canceled"
+
+
+class ApptCB(CallbackData, prefix="ap"):
+    """
+    callback_data кнопок записи: ap:<action>:<id>, action — confirm или cancel.
+    """
+    action: str
+    id: int
+
+
+# Шаблон кнопки отмены: копируем его вместо повторной валидации pydantic-модели для каждой записи
+CANCEL_BUTTON = InlineKeyboardButton(text="Отменить", callback_data=ApptCB(action="cancel", id=0).pack())
+
+
+def make_cancel_button(app_id: int, service: str, date_time: str) -> InlineKeyboardButton:
+    return CANCEL_BUTTON.model_copy(update={
+        'text': f"Отменить: {service}, {date_time if date_time else '—'}",
+        'callback_data': ApptCB(action="cancel", id=app_id).pack(),
+    })
+
+
+def render_appointments(rows, cancelable: bool):
+    """
+    Собирает записи пользователя в как можно меньшее число сообщений (обычно одно).
+    Возвращает список (текст, клавиатура); если cancelable, у каждой записи в клавиатуре
+    своя кнопка «Отменить». Новое сообщение начинается, только если текст не влезает в лимит Telegram.
+    """
+    chunks = []
+    chunk, length = [], 0
+    for row in rows:
+        app_id, service, date_time, status, created_at = row
+        text_block = (
+            f"<b>Услуга:</b> {service}\n"
+            f"<b>Дата/Время:</b> {date_time if date_time else '—'}\n"
+            f"<b>Статус:</b> {status}\n"
+            f"<b>Создано:</b> {created_at}"
+        )
+        if chunk and length + len(text_block) + 2 > MESSAGE_LIMIT:
+            chunks.append(chunk)
+            chunk, length = [], 0
+        chunk.append((row, text_block))
+        length += len(text_block) + 2
+    if chunk:
+        chunks.append(chunk)
+
+    messages = []
+    for chunk in chunks:
+        text = "\n\n".join(text_block for _, text_block in chunk)
+        keyboard = None
+        if cancelable:
+            keyboard = InlineKeyboardMarkup(inline_keyboard=[
+                [make_cancel_button(row[0], row[1], row[2])] for row, _ in chunk
+            ])
+        messages.append((text, keyboard))
+    return messages
+
+
+async def handle_book(message: Message):
+    await message.answer("Выберите услугу:", reply_markup=SERVICES_KB)
+
+
+async def handle_list(message: Message):
+    user_id = message.from_user.id
+    # Активные (с кнопками отмены) и отменённые записи выбираем раздельно, без ветвления по статусу
+    async with pool.reader() as db:
+        active = await db.execute_fetchall('''
+            SELECT id, service, date_time, status, created_at
+            FROM appointments
+            WHERE user_id = ? AND status != ?
+            ORDER BY id DESC
+        ''', (user_id, STATUS_CANCELED))
+        canceled = await db.execute_fetchall('''
+            SELECT id, service, date_time, status, created_at
+            FROM appointments
+            WHERE user_id = ? AND status = ?
+            ORDER BY id DESC
+        ''', (user_id, STATUS_CANCELED))
+
+    if active or canceled:
+        for text, keyboard in render_appointments(active, cancelable=True) + render_appointments(canceled, cancelable=False):
+            await message.answer(text, reply_markup=keyboard)
+    else:
+        await message.answer("У вас пока нет записей.")
+
+
+async def handle_help(message: Message):
+    await message.answer("Добро пожаловать в службу поддержки! Мы понимаем, что не работает — мы тоже в шоке, но не переживайте!")
 
-@router.message(lambda msg: msg.text in ["Записаться", "Мои Записи", "Помощь"])
-async def handle_main_menu(message: Message):
-    if message.text == "Записаться":
-        # Русские названия услуг
-        b1 = InlineKeyboardButton(text="Маникюр", callback_data="service_manicure")
-        b2 = InlineKeyboardButton(text="Педикюр", callback_data="service_pedicure")
-        b3 = InlineKeyboardButton(text="Брови", callback_data="service_eyebrows")
-        b4 = InlineKeyboardButton(text="Ресницы", callback_data="service_eyelashes")
-
-        markup = InlineKeyboardMarkup(inline_keyboard=[[b1, b2], [b3, b4]])
-        await message.answer("Выберите услугу:", reply_markup=markup)
-
-    elif message.text == "Мои Записи":
-        user_id = message.from_user.id
-        async with aiosqlite.connect(DATABASE) as db:
-            cursor = await db.execute('''
-                SELECT id, service, date_time, status, created_at
-                FROM appointments
-                WHERE user_id = ?
-                ORDER BY id DESC
-            ''', (user_id,))
-            rows = await cursor.fetchall()
-
-        if rows:
-            messages = []
-            for row in rows:
-                app_id, service, date_time, status, created_at = row
-
-                text_block = (
-                    f"<b>Услуга:</b> {service}\n"
-                    f"<b>Дата/Время:</b> {date_time if date_time else '—'}\n"
-                    f"<b>Статус:</b> {status}\n"
-                    f"<b>Создано:</b> {created_at}"
-                )
-
-                # Если статус не canceled, добавим кнопку "Отменить"
-                if status != "canceled":
-                    cancel_btn = InlineKeyboardButton(
-                        text="Отменить",
-                        callback_data=f"cancel_app_{app_id}"
-                    )
-                    kb = InlineKeyboardMarkup(inline_keyboard=[[cancel_btn]])
-                    messages.append((text_block, kb))
-                else:
-                    messages.append((text_block, None))
-
-            for block, keyboard in messages:
-                await message.answer(block, reply_markup=keyboard)
-        else:
-            await message.answer("У вас пока нет записей.")
 
-    elif message.text == "Помощь":
-        await message.answer("Добро пожаловать в службу поддержки! Мы понимаем, что не работает — мы тоже в шоке, но не переживайте!")
+# Кнопка главного меню -> обработчик
+MAIN_MENU_ACTIONS = {
+    "Записаться": handle_book,
+    "Мои Записи": handle_list,
+    "Помощь": handle_help,
+}
+MAIN_MENU_TEXTS = frozenset(MAIN_MENU_ACTIONS)
+
+
+@router.message(F.text.in_(MAIN_MENU_TEXTS))
+async def handle_main_menu(message: Message):
+    await MAIN_MENU_ACTIONS[message.text](message)
 
 
 # ==================================================
@@ -433,35 +864,24 @@ async def handle_main_menu(message: Message):
 # ==================================================
 async def create_pending_appointment(user_id: int, service: str) -> int:
     now_str = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    async with aiosqlite.connect(DATABASE) as db:
-        c = await db.execute("SELECT pending_appointment_id FROM users WHERE id = ?", (user_id,))
-        row = await c.fetchone()
-        old_appointment_id = row[0] if row else None
+    # Определяем русское название услуги
+    service_name = SERVICE_NAMES.get(service, service)
 
+    async with pool.writer() as db:
+        # Всё в одной транзакции (BEGIN IMMEDIATE открывает pool.writer())
         # Удаляем старую, если есть (и она в статусе 'pending')
-        if old_appointment_id:
-            await db.execute(
-                "DELETE FROM appointments WHERE id = ? AND status='pending'",
-                (old_appointment_id,)
-            )
-
-        # Определяем русское название услуги
-        if service == "manicure":
-            service_name = "Маникюр"
-        elif service == "pedicure":
-            service_name = "Педикюр"
-        elif service == "eyebrows":
-            service_name = "Брови"
-        elif service == "eyelashes":
-            service_name = "Ресницы"
-        else:
-            service_name = service  # fallback
+        await db.execute('''
+            DELETE FROM appointments
+            WHERE id = (SELECT pending_appointment_id FROM users WHERE id = ?) AND status='pending'
+        ''', (user_id,))
 
-        cursor = await db.execute('''
+        # RETURNING требует SQLite 3.35+
+        async with db.execute('''
             INSERT INTO appointments (user_id, service, date_time, status, created_at)
             VALUES (?, ?, ?, 'pending', ?)
-        ''', (user_id, service_name, None, now_str))
-        new_id = cursor.lastrowid
+            RETURNING id
+        ''', (user_id, service_name, None, now_str)) as cursor:
+            (new_id,) = await cursor.fetchone()
 
         await db.execute(
             "UPDATE users SET pending_appointment_id = ? WHERE id = ?",
@@ -474,21 +894,16 @@ async def create_pending_appointment(user_id: int, service: str) -> int:
 # ==================================================
 # Хендлер inline-кнопок выбора услуги
 # ==================================================
-@router.callback_query(lambda c: c.data and c.data.startswith("service_"))
+@router.callback_query(F.data.startswith("service_"))
 async def handle_service_choice(callback_query: CallbackQuery):
     user_id = callback_query.from_user.id
-    service_code = callback_query.data.split("_", maxsplit=1)[1]
+    service_code = callback_query.data.partition("_")[2]
 
     appointment_id = await create_pending_appointment(user_id, service_code)
 
 
     await callback_query.answer()
-    rus_name = {
-        "manicure": "Маникюр",
-        "pedicure": "Педикюр",
-        "eyebrows": "Брови",
-        "eyelashes": "Ресницы"
-    }.get(service_code, service_code)
+    rus_name = SERVICE_NAMES.get(service_code, service_code)
 
     await callback_query.message.answer(
         f"Вы выбрали услугу: <b>{rus_name}</b>.\n\n"
@@ -503,13 +918,13 @@ def parse_and_format_datetime(date_str: str, time_str: str) -> str:
     """
     Ожидаем, что GigaChat вернёт дату типа '25.01.2025' и время '14:30'.
     Приводим к формату 'дд.мм.гг чч:мм:сс'.
-    Если используем 4-значный год, меняем '%d.%m.%y' на '%d.%m.%Y'.
+    Если используем 4-значный год, меняем SLOT_FORMAT.
     """
     # Попробуем несколько форматов:
-    for date_fmt in ("%d.%m.%Y %H:%M", "%d.%m.%y %H:%M"):
+    for date_fmt in INPUT_DATETIME_FORMATS:
         try:
             dt = datetime.strptime(f"{date_str} {time_str}", date_fmt)
-            return dt.strftime("%d.%m.%y %H:%M:%S")
+            return dt.strftime(SLOT_FORMAT)
         except ValueError:
             pass
 
@@ -525,39 +940,18 @@ async def handle_free_text(message: Message):
     user_input = message.text.strip()
 
     # Смотрим, есть ли pending-запись
-    async with aiosqlite.connect(DATABASE) as db:
+    async with pool.reader() as db:
         c = await db.execute("SELECT pending_appointment_id FROM users WHERE id=?", (user_id,))
         row = await c.fetchone()
-        pending_appointment_id = row[0] if row else None
+    pending_appointment_id = row[0] if row else None
 
     if pending_appointment_id:
-        # Отправляем запрос GigaChat
-        system_prompt = SystemMessage(
-            content="Ты – ассистент, извлекающий дату и время из текста."
-        )
-        user_prompt = HumanMessage(
-            content=(
-                    "Текст пользователя: «" + user_input + "»\n\n"
-                                                           "Требуется выделить предполагаемую дату и время. "
-                                                           "Если в дате не указан год, то ставь по умолчанию 2025."
-                                                            "Формат ответа: DATE: <дд.чч.гггг> TIME: <время>, "
-                                                           "или NOT_FOUND, если не удалось определить."
-            )
-        )
-        response = llm([system_prompt, user_prompt])
-        content = response.content.strip()
-        logger.info(f"GigaChat response: {content}")
-
-        if "NOT_FOUND" in content.upper():
+        extracted = await extract_date_time(user_input)
+        if extracted is None:
             await message.answer("Не удалось понять дату/время. Попробуйте снова.")
             return
 
-        date_match = re.search(r"DATE:\s*(.+?)(?:\s|$)", content, re.IGNORECASE)
-        time_match = re.search(r"TIME:\s*(.+?)(?:\s|$)", content, re.IGNORECASE)
-
-        extracted_date = date_match.group(1).strip() if date_match else None
-        extracted_time = time_match.group(1).strip() if time_match else None
-
+        extracted_date, extracted_time = extracted
         if not (extracted_date and extracted_time):
             await message.answer("Не удалось извлечь дату/время. Попробуйте снова.")
             return
@@ -576,18 +970,18 @@ async def handle_free_text(message: Message):
             return
 
         # Записываем дату/время в БД
-        async with aiosqlite.connect(DATABASE) as db:
+        async with pool.writer() as db:
             await db.execute('''
                 UPDATE appointments
-                SET date_time = ?
+                SET date_time = ?, dt_epoch = ?
                 WHERE id = ? AND user_id = ?
-            ''', (final_dt_str, pending_appointment_id, user_id))
+            ''', (final_dt_str, slot_epoch(final_dt_str), pending_appointment_id, user_id))
             await db.commit()
 
         # Предлагаем подтвердить
         kb = InlineKeyboardMarkup(inline_keyboard=[[
-            InlineKeyboardButton(text="Да", callback_data=f"confirm_{pending_appointment_id}"),
-            InlineKeyboardButton(text="Нет", callback_data=f"cancel_{pending_appointment_id}")
+            InlineKeyboardButton(text="Да", callback_data=ApptCB(action="confirm", id=pending_appointment_id).pack()),
+            InlineKeyboardButton(text="Нет", callback_data=ApptCB(action="cancel", id=pending_appointment_id).pack())
         ]])
         await message.answer(
             f"Вы выбрали дату и время: <b>{final_dt_str}</b>\nПодтверждаете запись?",
@@ -600,221 +994,214 @@ async def handle_free_text(message: Message):
 # ==================================================
 # Обработчики подтверждения/отмены (confirm / cancel)
 # ==================================================
-@router.callback_query(lambda c: c.data and (c.data.startswith("confirm_")))
-async def handle_confirmation(callback_query: CallbackQuery):
+@router.callback_query(ApptCB.filter(F.action == "confirm"))
+async def handle_confirmation(callback_query: CallbackQuery, callback_data: ApptCB):
     user_id = callback_query.from_user.id
-    data = callback_query.data
-    action, appointment_id_str = data.split("_", maxsplit=1)
-    appointment_id = int(appointment_id_str.split('_')[-1])
-
-    async with aiosqlite.connect(DATABASE) as db:
-        cursor = await db.execute(
-            "SELECT status, date_time, service FROM appointments WHERE id = ? AND user_id = ?",
-            (appointment_id, user_id)
-        )
-        row = await cursor.fetchone()
-        if not row:
-            await callback_query.answer("Запись не найдена.", show_alert=True)
-            return
-
-        status, date_time_str, service_name = row
-        if status != "pending":
-            await callback_query.answer("Эта запись уже подтверждена/отменена или недоступна.", show_alert=True)
-            return
-
-        if action == "confirm":
-            # Подтверждаем -> status='confirmed'
-            await db.execute('''
-                UPDATE appointments
-                SET status='confirmed'
-                WHERE id = ? AND user_id = ?
-            ''', (appointment_id, user_id))
-
-            # Сбрасываем pending_appointment_id
-            await db.execute('''
-                UPDATE users
-                SET pending_appointment_id = NULL
-                WHERE id = ?
-            ''', (user_id,))
+    appointment_id = callback_data.id
 
-            # Получаем телефон
-            c2 = await db.execute("SELECT phone FROM users WHERE id = ?", (user_id,))
-            row2 = await c2.fetchone()
-            user_phone = row2[0] if row2 else 'Неизвестно'
+    try:
+        async with pool.writer() as db:
+            # Подтверждаем -> status='confirmed' и одним запросом получаем запись и телефон.
+            # Если запись не найдена или уже не 'pending', строк не вернётся.
+            async with db.execute(SQL_CONFIRM_APPOINTMENT, (appointment_id, user_id, user_id)) as cursor:
+                row = await cursor.fetchone()
+
+            if row is not None:
+                # Сбрасываем pending_appointment_id
+                await db.execute(SQL_RESET_PENDING, (user_id,))
             await db.commit()
+        if row is not None:
+            # Новая подтверждённая запись: планировщику нужно пересчитать, когда просыпаться
+            wake_reminder_scheduler()
+    except Exception as e:
+        # Транзакция откатана pool.writer(), запись осталась неподтверждённой
+        logger.error("Не удалось подтвердить запись %s: %s", appointment_id, e)
+        await callback_query.answer("Не удалось подтвердить запись. Попробуйте ещё раз позже.", show_alert=True)
+        return
 
-            await callback_query.answer("Запись подтверждена!", show_alert=False)
-            await callback_query.message.answer(
-                f"Отлично! Ваша запись на <b>{service_name}</b> "
-                f"в {date_time_str} подтверждена."
-            )
-
-            # Сохраняем в календарь (передаём appointment_id, чтобы потом при отмене удалить и из календаря)
-            date_part, time_part = date_time_str.split(" ", 1)  # 'дд.мм.гг', 'чч:мм:сс'
-            await save_to_calendar(
-                appointment_id=appointment_id,
-                user_id=user_id,
-                service_name=service_name,
-                date_str=date_part,
-                time_str=time_part,
-                user_phone=user_phone
-            )
-
-        elif action == "cancel":
-            # Удаляем запись со статус 'pending'
-            await db.execute('DELETE FROM appointments WHERE id = ? AND user_id = ?', (appointment_id, user_id))
-            await db.execute('''
-                UPDATE users
-                SET pending_appointment_id = NULL
-                WHERE id = ?
-            ''', (user_id,))
-            await db.commit()
+    if row is None:
+        await callback_query.answer("Эта запись уже подтверждена/отменена или недоступна.", show_alert=True)
+        return
 
-            await callback_query.answer("Запись отменена.", show_alert=False)
-            await callback_query.message.answer("Вы отменили текущую запись. Можете заново выбрать услугу.")
+    date_time_str, service_name, user_phone = row
+    if user_phone is None:
+        user_phone = 'Неизвестно'
+
+    # Сохраняем в календарь в фоне (передаём appointment_id, чтобы потом при отмене удалить и из календаря)
+    date_part, time_part = date_time_str.split(" ", 1)  # 'дд.мм.гг', 'чч:мм:сс'
+    run_in_background(save_to_calendar(
+        appointment_id=appointment_id,
+        user_id=user_id,
+        service_name=service_name,
+        date_str=date_part,
+        time_str=time_part,
+        user_phone=user_phone
+    ))
+
+    # Запись уже зафиксирована: ответ на нажатие и сообщение отправляем параллельно
+    await asyncio.gather(
+        callback_query.answer("Запись подтверждена!", show_alert=False),
+        callback_query.message.answer(
+            f"Отлично! Ваша запись на <b>{service_name}</b> "
+            f"в {date_time_str} подтверждена."
+        ),
+    )
 
 
-@router.callback_query(lambda c: c.data and c.data.startswith("cancel_"))
-async def handle_confirmation(callback_query: CallbackQuery):
+@router.callback_query(ApptCB.filter(F.action == "cancel"))
+async def handle_cancel_callback(callback_query: CallbackQuery, callback_data: ApptCB):
+    """
+    Отмена записи: кнопка «Нет» под черновой записью
+    или «Отменить» в «Мои Записи».
+    """
     user_id = callback_query.from_user.id
-    data = callback_query.data
-    action, appointment_id_str = data.split("_", maxsplit=1)
-    appointment_id = int(appointment_id_str.split('_')[-1])
-
-    async with aiosqlite.connect(DATABASE) as db:
-        cursor = await db.execute(
-            "SELECT status, date_time, service, google_event_id FROM appointments WHERE id = ? AND user_id = ?",
-            (appointment_id, user_id)
-        )
-        row = await cursor.fetchone()
-        if not row:
-            await callback_query.answer("Запись не найдена.", show_alert=True)
-            return
+    appointment_id = callback_data.id
 
-        status, date_time_str, service_name, google_event_id = row
-        if status == "pending":
-            await callback_query.answer("Эта запись уже подтверждена/отменена или недоступна.", show_alert=True)
-            return
+    async with pool.writer() as db:
+        # Удаляем запись и сразу получаем её данные; при повторном нажатии строк не вернётся,
+        # поэтому событие в календаре удалит только один обработчик.
+        async with db.execute(SQL_DELETE_APPOINTMENT, (appointment_id, user_id)) as cursor:
+            row = await cursor.fetchone()
 
-        if action == "confirm":
-            # Подтверждаем запись, изменяя статус на 'confirmed'
-            await db.execute('''UPDATE appointments SET status='confirmed' WHERE id = ? AND user_id = ?''',
-                             (appointment_id, user_id))
+        if row is not None:
+            # Сбрасываем pending_appointment_id, только если он указывал на эту запись
+            await db.execute(SQL_RESET_PENDING_IF, (user_id, appointment_id))
+        await db.commit()
 
-            # Сбрасываем pending_appointment_id у пользователя
-            await db.execute('''UPDATE users SET pending_appointment_id = NULL WHERE id = ?''', (user_id,))
+    if row is None:
+        await callback_query.answer("Запись не найдена.", show_alert=True)
+        return
 
-            # Получаем номер телефона пользователя
-            c2 = await db.execute("SELECT phone FROM users WHERE id = ?", (user_id,))
-            row2 = await c2.fetchone()
-            user_phone = row2[0] if row2 else 'Неизвестно'
-            await db.commit()
+    date_time_str, google_event_id = row
 
-            await callback_query.answer("Запись подтверждена!", show_alert=False)
-            await callback_query.message.answer(
-                f"Отлично! Ваша запись на <b>{service_name}</b> в {date_time_str} подтверждена."
+    # Удаляем событие из Google Calendar, если оно существует
+    if google_event_id:
+        loop = asyncio.get_running_loop()
+        try:
+            # Вызываем функцию для удаления события из Google Calendar
+            await loop.run_in_executor(
+                GCAL_POOL, calendar_service.delete_event, CALENDAR_ID, google_event_id
             )
+            logger.info("Событие с ID %s успешно удалено из Google Календаря.", google_event_id)
+            invalidate_availability(date_time_str.split(" ", 1)[0])
+        except Exception as e:
+            logger.error("Не удалось удалить событие из Google Календаря: %s", e)
+            await callback_query.answer("Не удалось удалить событие из Google Календаря. Попробуйте позже.",
+                                        show_alert=True)
+            return
 
-            # Сохраняем в Google Calendar
-            date_part, time_part = date_time_str.split(" ", 1)  # 'дд.мм.гг', 'чч:мм:сс'
-            await save_to_calendar(
-                appointment_id=appointment_id,
-                user_id=user_id,
-                service_name=service_name,
-                date_str=date_part,
-                time_str=time_part,
-                user_phone=user_phone
-            )
+    await callback_query.answer("Запись отменена.", show_alert=False)
+    await callback_query.message.answer("Вы отменили текущую запись. Можете заново выбрать услугу.")
 
-        elif action == "cancel":
-            # Удаляем запись со статусом 'pending'
-            await db.execute('DELETE FROM appointments WHERE id = ? AND user_id = ?', (appointment_id, user_id))
-            await db.execute('''UPDATE users SET pending_appointment_id = NULL WHERE id = ?''', (user_id,))
-            await db.commit()
 
-            # Удаляем событие из Google Calendar, если оно существует
-            if google_event_id:
-                loop = asyncio.get_running_loop()
-                try:
-                    # Вызываем функцию для удаления события из Google Calendar
-                    await loop.run_in_executor(
-                        None,
-                        lambda: calendar_service.delete_event(CALENDAR_ID, google_event_id)
-                    )
-                    logger.info(f"Событие с ID {google_event_id} успешно удалено из Google Календаря.")
-                except Exception as e:
-                    logger.error(f"Не удалось удалить событие из Google Календаря: {e}")
-                    await callback_query.answer("Не удалось удалить событие из Google Календаря. Попробуйте позже.",
-                                                show_alert=True)
-                    return
+@router.callback_query(F.data.regexp(r"^(confirm|cancel)_"))
+async def handle_legacy_callback(callback_query: CallbackQuery):
+    """
+    Кнопки из сообщений, отправленных до перехода на ApptCB:
+    confirm_<id>, cancel_<id> и cancel_app_<id> передаём в актуальные обработчики.
+    """
+    action, _, rest = callback_query.data.partition("_")
+    try:
+        appointment_id = int(rest.rpartition("_")[2])
+    except ValueError:
+        await callback_query.answer("Кнопка устарела, откройте «Мои Записи».", show_alert=True)
+        return
 
-            await callback_query.answer("Запись отменена.", show_alert=False)
-            await callback_query.message.answer("Вы отменили текущую запись. Можете заново выбрать услугу.")
+    callback_data = ApptCB(action=action, id=appointment_id)
+    if action == "confirm":
+        await handle_confirmation(callback_query, callback_data)
+    else:
+        await handle_cancel_callback(callback_query, callback_data)
 
 
 
 # ==================================================
 # Напоминание пользователям за 2 часа до услуги
 # ==================================================
+# Будильник планировщика: подтверждение записи будит его раньше срока.
+# Создаётся в reminder_scheduler(), т.е. уже внутри работающего event loop
+reminder_wakeup = None
+
+
+def wake_reminder_scheduler():
+    if reminder_wakeup is not None:
+        reminder_wakeup.set()
+
+
 async def reminder_scheduler():
     """
-    Каждую минуту проверяем записи, у которых статус = 'confirmed',
-    до начала которых осталось <= 2 часа, и отправляем напоминание, если ещё не отправляли.
+    Ищем записи со статусом 'confirmed', до начала которых осталось <= 2 часа,
+    и отправляем напоминание, если ещё не отправляли.
+    Окно по времени отбирается в SQL по индексу idx_appt_due, а не разбором всех записей в Python.
+    Между проверками спим до момента, когда ближайшая запись войдёт в окно; новое подтверждение
+    будит планировщик через wake_reminder_scheduler(). Если записей нет, проверок тоже нет.
+    После ошибок пауза удваивается (до REMINDER_MAX_BACKOFF), первая удачная проверка её сбрасывает.
     """
+    global reminder_wakeup
+    reminder_wakeup = asyncio.Event()
+    semaphore = asyncio.Semaphore(REMINDER_SEND_CONCURRENCY)
+
+    async def send_reminder(user_id, service_name, dt_str):
+        async with semaphore:
+            await bot.send_message(
+                user_id,
+                f"Напоминание! Ваша запись на <b>{service_name}</b> начинается через ~2 часа.\n"
+                f"Дата и время: {dt_str}"
+            )
+
+    backoff = REMINDER_POLL_INTERVAL
     while True:
+        # Подтверждения, пришедшие во время проверки, снова взведут событие
+        reminder_wakeup.clear()
+        sleep_for = None  # None — ждём, пока разбудят
         try:
-            now = datetime.now(pytz.timezone(TIMEZONE))
-            async with aiosqlite.connect(DATABASE) as db:
-                # Ищем неподтверждённые напоминания для confirmed-записей
-                # date_time хранится в формате 'дд.мм.гг чч:мм:сс'
-                cursor = await db.execute('''
-                    SELECT id, user_id, service, date_time, reminded
-                    FROM appointments
-                    WHERE status = 'confirmed' AND reminded = 0
-                ''')
+            # Секунды Unix не зависят от часового пояса, datetime здесь не нужен
+            now_epoch = int(time.time())
+            async with pool.reader() as db:
+                # Ищем неподтверждённые напоминания для confirmed-записей, до начала которых <= 2 часов
+                cursor = await db.execute(SQL_DUE_REMINDERS, (now_epoch, now_epoch + REMINDER_WINDOW))
                 rows = await cursor.fetchall()
 
-            for row in rows:
-                app_id, user_id, service_name, dt_str, reminded = row
-
-                # Преобразуем дату/время
-                try:
-                    dt = datetime.strptime(dt_str, "%d.%m.%y %H:%M:%S")
-                    dt = pytz.timezone(TIMEZONE).localize(dt)
-                except ValueError:
-                    continue  # некорректный формат, пропустим
-
-                if dt <= now:
-                    # Если запись уже в прошлом, смысла напоминать нет
+            # Отправляем напоминания параллельно, не больше REMINDER_SEND_CONCURRENCY запросов сразу
+            results = await asyncio.gather(
+                *(send_reminder(user_id, service_name, dt_str) for _, user_id, service_name, dt_str in rows),
+                return_exceptions=True
+            )
+            sent_ids = []
+            for (app_id, user_id, _, _), result in zip(rows, results):
+                if isinstance(result, Exception):
+                    logger.error("Не удалось отправить напоминание пользователю %s: %s", user_id, result)
+                    # Запись остаётся в окне с reminded = 0, повторим через REMINDER_POLL_INTERVAL
+                    sleep_for = REMINDER_POLL_INTERVAL
                     continue
-
-                diff = dt - now
-                # Если до начала <= 2 часов
-                if 0 < diff.total_seconds() <= 7200:
-                    # Отправляем напоминание
-                    try:
-                        await bot.send_message(
-                            user_id,
-                            f"Напоминание! Ваша запись на <b>{service_name}</b> начинается через ~2 часа.\n"
-                            f"Дата и время: {dt_str}"
-                        )
-                    except Exception as e:
-                        logger.error(f"Не удалось отправить напоминание пользователю {user_id}: {e}")
-                        continue
-
-                    # Обновляем флаг reminded
-                    async with aiosqlite.connect(DATABASE) as db:
-                        await db.execute(
-                            "UPDATE appointments SET reminded=1 WHERE id=?",
-                            (app_id,)
-                        )
-                        await db.commit()
+                sent_ids.append((app_id,))
+
+            # Обновляем флаг reminded одной транзакцией на все отправленные напоминания
+            if sent_ids:
+                async with pool.writer() as db:
+                    await db.executemany(SQL_MARK_REMINDED, sent_ids)
+                    await db.commit()
+
+            # Ближайшая запись, которая ещё не вошла в окно напоминания
+            async with pool.reader() as db:
+                cursor = await db.execute(SQL_NEXT_REMINDER, (now_epoch + REMINDER_WINDOW,))
+                (next_due,) = await cursor.fetchone()
+            if next_due is not None:
+                until_due = max(1, next_due - REMINDER_WINDOW - now_epoch)
+                sleep_for = until_due if sleep_for is None else min(sleep_for, until_due)
+            backoff = REMINDER_POLL_INTERVAL
 
         except Exception as e:
-            logger.error(f"Ошибка в планировщике напоминаний: {e}")
+            # БД заблокирована или Telegram недоступен: не долбим их с прежней частотой
+            backoff = min(REMINDER_MAX_BACKOFF, backoff * 2)
+            sleep_for = backoff
+            logger.error("Ошибка в планировщике напоминаний: %s (повтор через %s с)", e, backoff)
 
-        # Ждём 60 секунд до следующего цикла
-        await asyncio.sleep(60)
+        # Ждём до следующего цикла или до нового подтверждения
+        try:
+            await asyncio.wait_for(reminder_wakeup.wait(), timeout=sleep_for)
+        except asyncio.TimeoutError:
+            pass
 
 
 # ==================================================
@@ -823,19 +1210,30 @@ async def reminder_scheduler():
 async def main():
     await start_db()
 
-    # Запускаем планировщик напоминаний
-    asyncio.create_task(reminder_scheduler())
+    # Запускаем планировщик напоминаний (держим ссылку, чтобы остановить его до закрытия БД)
+    reminder_task = asyncio.create_task(reminder_scheduler())
 
     dp.message.outer_middleware(RegistrationMiddleware())
     dp.include_router(router)
 
     try:
-        print("Бот запущен...")
+        logger.info("Бот запущен...")
         await bot.delete_webhook(drop_pending_updates=True)
-        await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
+        # Сессию бота закрываем сами в finally, после фоновых задач, которым она ещё нужна
+        await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types(), close_bot_session=False)
     finally:
+        reminder_task.cancel()
+        try:
+            await reminder_task
+        except asyncio.CancelledError:
+            pass
+        # Даём фоновым записям в календарь завершиться, пока открыты БД и сессия бота
+        if BACKGROUND_TASKS:
+            await asyncio.wait(BACKGROUND_TASKS, timeout=10)
         await bot.session.close()
-        print("Бот остановлен")
+        await pool.close()
+        GCAL_POOL.shutdown(wait=False)
+        logger.info("Бот остановлен")
 
 
 if __name__ == "__main__":